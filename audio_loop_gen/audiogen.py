@@ -1,15 +1,32 @@
+import hashlib
 import logging
+import os
 import warnings
-from typing import Tuple, Callable
+from typing import Dict, List, Tuple, Callable
 
 import numpy as np
 from numpy import ndarray
 import torch
 
 from audiocraft.models import MusicGen
+from audiocraft.modules.transformer import StreamingMultiheadAttention
 
 from .util import set_all_seeds, AudioGenParams
+
 DEFAULT_MODEL_ID = "facebook/musicgen-stereo-large"
+# Every prompt in a batch adds a whole generation's worth of GPU memory (twice that with classifier-free guidance),
+# so batching is opt-in: a GPU which fits a single generation must keep working with the defaults
+DEFAULT_MAX_BATCH_SIZE = 1
+# Durations up to this many seconds over the model's generation window are generated at the window's length.
+# Going over the window costs a whole extra window pass (re-prompted with `max_duration - extend_stride` seconds of audio),
+# which isn't worth it for a couple of seconds of audio that the loop generator will likely cut anyway.
+DURATION_TOLERANCE = 3.0
+
+# The maximum size of the generated audio cache. The least recently used files are removed when it grows over it.
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024**3
+
+# Loaded models shared by all AudioGenerator instances in the process, keyed by (model_id, device, quantize)
+_MODEL_CACHE: Dict[Tuple[str, str, bool], MusicGen] = {}
 
 warnings.filterwarnings("ignore", category=UserWarning) # for pytorch deprecation warnings from MusicGen
 
@@ -17,13 +34,47 @@ class AudioGenerator:
     """ Generates an audio segment using one of Meta's Audiocraft:MusicGen models.
     """
 
-    def __init__(self, model_id: str = None, device: str = None, progress:bool=True):
+    def __init__(self, model_id: str = None, device: str = None, progress:bool=True, quantize: bool = False, cache_dir: str = None,
+                 cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        """ Creates a new AudioGenerator and loads the model.
+
+        Args:
+            model_id (str, optional): The MusicGen model to use. Defaults to DEFAULT_MODEL_ID.
+            device (str, optional): The torch device to run the model on. Defaults to "cuda" if available, otherwise "cpu".
+            progress (bool, optional): Whether to report the generation progress. Defaults to True.
+            quantize (bool, optional): Store the transformer's linear layer weights as int8 to roughly halve the GPU memory
+                they need. Requires CUDA and the bitsandbytes package. Defaults to False.
+            cache_dir (str, optional): A folder where to cache the generated audio. Only generations with an explicit seed are
+                cached, as only they can be repeated. Defaults to no caching.
+            cache_max_bytes (int, optional): The maximum size of the cache folder's audio files, the least recently used
+                ones are removed when it's exceeded. Defaults to DEFAULT_CACHE_MAX_BYTES.
+        """
         self.device = device or (
             "cuda" if torch.cuda.is_available() else "cpu")
+        # the type, so "cuda:1" etc. count as well
+        self.__on_cuda = torch.device(self.device).type == "cuda"
+        if quantize and not self.__on_cuda:
+            raise ValueError("Quantization is only supported on CUDA devices")
         self.__progress = progress
+        self.__quantize = quantize
+        self.__cache_dir = cache_dir
+        self.__cache_max_bytes = cache_max_bytes
+        self.__model_id = None
         self.__model = None
-        self.__load(model_id)
         self.__logger = logging.getLogger("global")
+        self.__load(model_id, quantize)
+
+    @property
+    def model_id(self) -> str:
+        return self.__model_id
+
+    @property
+    def quantize(self) -> bool:
+        return self.__quantize
+
+    @property
+    def cache_dir(self) -> str:
+        return self.__cache_dir
 
     def generate(self, params: AudioGenParams) -> Tuple[int, ndarray]:
         """ Generates an audio segment using the given parameters.
@@ -39,40 +90,231 @@ class AudioGenerator:
         """
         if not params:
             raise ValueError("Missing generation params")
-        
-        seed = params.seed
-        if not seed or seed < 0:
-            seed = torch.seed() % (2**32 - 1)
-        elif seed >= 2**32 - 1:
-            raise ValueError(f"Seed must be less than {2**32 - 1}")
-        set_all_seeds(seed)
+        return self.generate_batch([params], max_batch_size=1)[0]
 
-        if params.bpm < 15 or params.bpm > 300:
-            raise ValueError(
-                f"Invalid bpm {params.bpm}, must be between 15.0 and 300.0")
+    def generate_batch(self, params_list: List[AudioGenParams], max_batch_size: int = DEFAULT_MAX_BATCH_SIZE) -> List[Tuple[int, ndarray]]:
+        """ Generates an audio segment for each of the given parameters.
 
-        prompt = f"{params.prompt} bpm: {params.bpm}"
+        Parameters without an explicit seed which share the same generation settings (duration and sampling options) are generated
+        together in batches of up to `max_batch_size` prompts, so the transformer runs once per batch instead of once per prompt.
+        Parameters with an explicit seed are always generated on their own, as the audio generated for a prompt in a batch also
+        depends on the other prompts in it, i.e. it wouldn't be reproducible.
+
+        Args:
+            params_list (List[AudioGenParams]): The parameters to use for generation.
+            max_batch_size (int, optional): The maximum number of prompts to generate at once. Defaults to DEFAULT_MAX_BATCH_SIZE.
 
-        self.__logger.info(
-            "Generating music using prompt \"%s\" and seed %d...", prompt, seed)
+        Raises:
+            ValueError: If any of the parameters are invalid.
+
+        Returns:
+            List[Tuple[int, ndarray]]: The sample rate and audio data for each of the parameters, in the same order.
+        """
+        if not params_list or any(not params for params in params_list):
+            raise ValueError("Missing generation params")
+        if max_batch_size < 1:
+            raise ValueError(f"Invalid max batch size {max_batch_size}")
+        results: List[Tuple[int, ndarray]] = [None] * len(params_list)
+        groups: Dict[tuple, List[int]] = {}
+        for i, params in enumerate(params_list):
+            self.__validate(params)
+            results[i] = self.__load_cached(params)
+            if results[i] is None:
+                groups.setdefault(self.__batch_key(params, i), []).append(i)
+
+        for indices in groups.values():
+            for start in range(0, len(indices), max_batch_size):
+                batch = indices[start:start + max_batch_size]
+                for i, result in zip(batch, self.__generate_batch([params_list[i] for i in batch])):
+                    results[i] = result
+                    self.__save_cached(params_list[i], result)
+        return results
+
+    @torch.inference_mode()
+    def __generate_batch(self, params_batch: List[AudioGenParams]) -> List[Tuple[int, ndarray]]:
+        """ Generates the given (validated) parameters in a single call to the model. They must share the same batch key.
+        """
+        params = params_batch[0]
+        seed = params.seed
+        reproducible = bool(seed) and seed > 0
+        if not reproducible:
+            # draw a fresh seed without reseeding every torch device generator (torch.seed() does) only to be reseeded below
+            seed = int.from_bytes(os.urandom(4), "little") % (2**32 - 1)
+        set_all_seeds(seed, deterministic=reproducible)
+
+        prompts = [f"{p.prompt} bpm: {p.bpm}" for p in params_batch]
+
+        for prompt in prompts:
+            self.__logger.info(
+                "Generating music using prompt \"%s\" and seed %d...", prompt, seed)
         
         self.__logger.debug("Generation params: %s", params)
 
-        duration: float = params.max_duration
+        duration: float = self.__duration(params)
         sample_rate = self.__model.sample_rate
         
         # generate the initial segment
         self.__model.set_generation_params(
             duration=duration, top_k=params.top_k, top_p=params.top_p, temperature=params.temperature, cfg_coef=params.cfg_coef, extend_stride=9)
-        wav = self.__model.generate([prompt], progress=self.__progress)
+        try:
+            wav = self.__model.generate(prompts, progress=self.__progress)
+        except torch.cuda.OutOfMemoryError:
+            # hand the memory of the failed generation back, so the next (maybe smaller) one has a chance.
+            # Not done after every generation, the allocator's cached blocks are what keeps the next one fast
+            torch.cuda.empty_cache()
+            raise
         
-        result = wav[0].cpu().numpy()
-        return sample_rate, result
+        result = wav.cpu().numpy()
+        # release the device copy right away instead of holding it until the next generation
+        del wav
+        return [(sample_rate, audio) for audio in result]
+
+    def __validate(self, params: AudioGenParams):
+        if params.seed and params.seed >= 2**32 - 1:
+            raise ValueError(f"Seed must be less than {2**32 - 1}")
+        if params.bpm < 15 or params.bpm > 300:
+            raise ValueError(
+                f"Invalid bpm {params.bpm}, must be between 15.0 and 300.0")
+
+    def __batch_key(self, params: AudioGenParams, index: int) -> tuple:
+        """ Parameters with the same key can be generated in the same batch. The key of seeded parameters is unique
+        (it includes their index in the request), so they are generated on their own.
+        """
+        if params.seed and params.seed > 0:
+            return ("seeded", index)
+        return (self.__duration(params), params.top_k, params.top_p, params.temperature, params.cfg_coef)
+
+    def __duration(self, params: AudioGenParams) -> float:
+        """ The duration to actually generate for the given parameters.
+        """
+        duration = params.max_duration
+        window = self.__model.max_duration
+        # loops must still be able to reach their minimum duration
+        min_duration = getattr(params, "min_duration", -1)
+        if window < duration <= window + DURATION_TOLERANCE and min_duration <= window:
+            return window
+        return duration
+
+    def __cache_path(self, params: AudioGenParams) -> str:
+        """ The cache file for the given parameters, None if they shouldn't be cached.
+        """
+        if not self.__cache_dir or not params.seed or params.seed < 0:
+            return None # a random seed never repeats
+        key = "|".join(str(value) for value in (self.__model_id, self.__quantize, params.prompt, params.bpm, params.seed,
+                                                self.__duration(params), params.top_k, params.top_p, params.temperature, params.cfg_coef))
+        return os.path.join(self.__cache_dir, f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.npz")
+
+    def __load_cached(self, params: AudioGenParams) -> Tuple[int, ndarray]:
+        path = self.__cache_path(params)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                result = (int(data["sample_rate"]), data["audio"])
+            os.utime(path) # recently used, the pruning goes by the modification time
+            self.__logger.info("Using cached audio for prompt \"%s\" and seed %d", params.prompt, params.seed)
+            return result
+        except Exception as e:
+            self.__logger.warning("Error reading cached audio %s: %s", path, e)
+            return None
+
+    def __save_cached(self, params: AudioGenParams, result: Tuple[int, ndarray]):
+        path = self.__cache_path(params)
+        if path is None:
+            return
+        try:
+            os.makedirs(self.__cache_dir, exist_ok=True)
+            # write to a temp file and rename, so no one reads a partially written file
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                np.savez(f, sample_rate=result[0], audio=result[1])
+            os.replace(temp_path, path)
+            self.__prune_cache()
+        except Exception as e:
+            self.__logger.warning("Error caching audio %s: %s", path, e)
+
+    def __prune_cache(self):
+        """ Removes the least recently used (written or read) cached audio files while the cache is over its maximum size.
+        """
+        entries = []
+        with os.scandir(self.__cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".npz") and entry.is_file():
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if total <= self.__cache_max_bytes:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # removed by another process in the meantime
+            total -= size
+            if total <= self.__cache_max_bytes:
+                break
+
+    @torch.inference_mode()
+    def warmup(self):
+        """ Runs a very short generation, so that the one-off costs of the first generation (CUDA context and kernel
+        initialization, allocator growth) are not paid by the first real request.
+        """
+        self.__model.set_generation_params(duration=1.0)
+        self.__model.generate(["warmup"], progress=False)
 
     def set_custom_progress_callback(self, callback:Callable[[int, int],None]):
         self.__model.set_custom_progress_callback(callback)
 
-    def __load(self, model_id: str = None):
+    def __load(self, model_id: str = None, quantize: bool = False):
         if model_id is None:
             model_id = DEFAULT_MODEL_ID
-        self.__model = MusicGen.get_pretrained(model_id, device=self.device)
+        self.__model_id = model_id
+        key = (model_id, self.device, quantize)
+        model = _MODEL_CACHE.get(key)
+        if model is None:
+            model = MusicGen.get_pretrained(model_id, device=self.device)
+            self.__use_sdpa(model)
+            if quantize:
+                self.__quantize_int8(model)
+            _MODEL_CACHE[key] = model
+        self.__model = model
+
+    def __use_sdpa(self, model: MusicGen):
+        """ Route the LM attention through torch's scaled_dot_product_attention (flash/memory-efficient kernels, with audiocraft's
+        default "torch" attention backend) instead of the explicit softmax(QK^T)V path, which is O(N^2) in memory for long
+        generation windows. Only needed for checkpoints which weren't configured with `memory_efficient` already.
+        """
+        attentions = switched = 0
+        for module in model.lm.modules():
+            if isinstance(module, StreamingMultiheadAttention) and module.custom:
+                attentions += 1
+                if not module.memory_efficient:
+                    # the flag only changes the layout of the (transient) streaming KV cache, not the weights
+                    module.memory_efficient = True
+                    switched += 1
+        self.__logger.debug("Switched %d of %d attention modules to scaled_dot_product_attention", switched, attentions)
+
+    def __quantize_int8(self, model: MusicGen):
+        """ Replace the linear layers of the LM's transformer with bitsandbytes int8 layers.
+        
+        The embeddings and the output projections (outside the transformer) keep their original precision,
+        as they have the most impact on the quality of the generated audio.
+        """
+        try:
+            import bitsandbytes as bnb
+        except ImportError as e:
+            raise ValueError("Quantization requires the bitsandbytes package") from e
+
+        for module in list(model.lm.transformer.modules()):
+            for name, child in list(module.named_children()):
+                if not isinstance(child, torch.nn.Linear):
+                    continue
+                quantized = bnb.nn.Linear8bitLt(child.in_features, child.out_features, bias=child.bias is not None,
+                                                has_fp16_weights=False, threshold=6.0)
+                # the weights are quantized when the layer is moved to the GPU
+                quantized.weight = bnb.nn.Int8Params(child.weight.data.cpu(), requires_grad=False, has_fp16_weights=False)
+                if child.bias is not None:
+                    quantized.bias = torch.nn.Parameter(child.bias.data.cpu(), requires_grad=False)
+                setattr(module, name, quantized.to(self.device))
+        if self.__on_cuda:
+            torch.cuda.empty_cache()
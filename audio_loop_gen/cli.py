@@ -1,16 +1,43 @@
 import os
+import sys
 from enum import Enum
 from typing_extensions import Annotated
 import asyncio
 import logging
+from typing import TYPE_CHECKING
 
 import typer
 
-from .audiogen import AudioGenerator
-from .loopgen import LoopGenerator
-from .store import AudioHandler, AudioStore, FileDataHandler, S3DataHandler
-from .util import AudioData, LoopGenParams, setup_logging
-from .promptgen import Ollama, OpenAI, Manual
+# Read by torch on the first CUDA allocation, so it has to be set before anything initializes CUDA (torch itself is only
+# imported below, when a command needs it). Lets the caching allocator grow segments in place instead of fragmenting
+# VRAM across repeated generations of different lengths.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
+# The modules below pull in torch, audiocraft, boto3 and the LLM clients, which take seconds to import.
+# They are imported where they are used, so that --help and invalid arguments don't pay for them.
+if TYPE_CHECKING:
+    from .audiogen import AudioGenerator
+    from .store import AudioStore
+    from .util import AudioData, LoopGenParams
+
+logger = logging.getLogger("global")
+
+# Loops generated within this many seconds of each other are saved together
+STORE_BATCH_WINDOW = 0.05
+STORE_BATCH_SIZE = 10
+# How many generated prompts can wait for the audio generation
+PARAMS_QUEUE_SIZE = 20
+# How many prompts to ask the prompt provider for at once, split into concurrent LLM requests of PROMPTS_PER_REQUEST each
+PROMPTS_PER_FETCH = 10
+PROMPTS_PER_REQUEST = 5
+# The maximum delay in seconds between retries of a failing prompt provider
+PROMPT_RETRY_MAX_DELAY = 5.0
+# How many times the generate command regenerates the audio when no loop is found in it
+GENERATE_MAX_RETRIES = 3
+# The number of dots printed for the progress of a generation
+PROGRESS_DOTS = 20
+# Where the generated audio is cached with --cache
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "audio_loop_gen")
 
 class PromptProvider(str, Enum):
     manual = "manual"
@@ -29,7 +56,9 @@ def create_store(
     file_prefix:str,
     s3_bucket:str,
     s3_path:str,
-    keep_metadata:bool) -> AudioStore:
+    keep_metadata:bool) -> "AudioStore":
+    from .store import AudioHandler, AudioStore, FileDataHandler
+
     # need to store somewhere
     if s3_bucket is None and dest_path is None:
         print("No storage destination specified, using current directory!")
@@ -37,6 +66,7 @@ def create_store(
 
     handlers:list[AudioHandler] = []
     if s3_bucket is not None:
+        from .store import S3DataHandler
         prefix = ""
         if s3_path:
             prefix += s3_path
@@ -50,7 +80,9 @@ def create_store(
     
     return AudioStore(handlers=handlers)
 
-def create_prompt_provider(prompt_provider:PromptProvider, llm_model:str, use_case:str, max_duration: int, min_duration: int) -> PromptProvider:
+def create_prompt_provider(prompt_provider:PromptProvider, llm_model:str, use_case:str, max_duration: int, min_duration: int, cache:bool = False) -> PromptProvider:
+    from .util import LoopGenParams
+
     def params_callback(prompt:str, bpm:int, **kwargs) -> LoopGenParams:
         _max_duration = kwargs.pop("max_duration", max_duration)
         _min_duration = kwargs.pop("min_duration", min_duration)
@@ -59,70 +91,196 @@ def create_prompt_provider(prompt_provider:PromptProvider, llm_model:str, use_ca
                             min_duration=_min_duration, **kwargs)
         
     if prompt_provider == PromptProvider.ollama:
+        from .promptgen import Ollama
         promptgen = Ollama(model_id=llm_model, use_case=use_case, params_callback=params_callback)
     elif prompt_provider == PromptProvider.openai:
+        from .promptgen import OpenAI
         api_key = os.environ.get("OPENAI_API_KEY")
         if not api_key:
             raise ValueError("Missing OPENAI_API_KEY environment variable!")
         promptgen = OpenAI(api_key=api_key, model_id=llm_model, use_case=use_case, params_callback=params_callback)
     else:
+        from .promptgen import Manual
         promptgen = Manual(use_case=use_case, params_callback=params_callback)
+    
+    if cache and prompt_provider != PromptProvider.manual:
+        from .promptgen import CachedPromptGenerator
+        # keep the LLM generated prompts which weren't used for the next run
+        promptgen = CachedPromptGenerator(promptgen, os.path.join(CACHE_DIR, "prompts.db"))
         
     return promptgen
 
-def create_audio_generator(audio_model:str) -> AudioGenerator:
+def create_audio_generator(audio_model:str, quantize:bool = False, warmup:bool = False, cache:bool = False) -> "AudioGenerator":
+    from .audiogen import AudioGenerator
+
     print("Loading audio model...")
-    audiogen = AudioGenerator(model_id=audio_model)
+    audiogen = AudioGenerator(model_id=audio_model, quantize=quantize, cache_dir=CACHE_DIR if cache else None)
+    if warmup:
+        # before the progress callback is set, so it doesn't report the warmup
+        audiogen.warmup()
+    # called for every generated token, so only write when a dot is due and flush every few dots
+    dots = 0 # printed for the current generation
     def progress_callback(generated, total):
-        step = total // 20
-        if step > 0 and generated % step == 0:
-            print(f'.', end='', flush=True)
+        nonlocal dots
+        due = generated * PROGRESS_DOTS // total if total > 0 else 0
+        if due < dots: # a new generation started
+            dots = 0
+        if due > dots:
+            sys.stdout.write("." * (due - dots))
+            if due // 5 != dots // 5 or due == PROGRESS_DOTS:
+                sys.stdout.flush()
+            dots = due
     audiogen.set_custom_progress_callback(progress_callback)
     return audiogen
 
-async def auto_loop(prompt_provider:PromptProvider, audio_store: AudioStore, audiogen: AudioGenerator):
-    logger = logging.getLogger("global")
+async def store_loops(audio_store: "AudioStore", queue: asyncio.Queue):
+    """ Saves the queued (loop, params) items in the background, in batches of the items which arrive close together.
+    """
     while True:
+        batch = [await queue.get()]
+        while len(batch) < STORE_BATCH_SIZE:
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout=STORE_BATCH_WINDOW))
+            except asyncio.TimeoutError:
+                break
         try:
+            await asyncio.to_thread(audio_store.store_many, batch)
+            print(f"\nSaved {len(batch)}")
+        except Exception as e:
+            logger.error("Error while saving loops: %s", e, exc_info=True)
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+async def auto_loop(prompt_provider:PromptProvider, audio_store: "AudioStore", audiogen: "AudioGenerator", batch_size: int = 1):
+    """ Runs the auto mode as a pipeline of three concurrent stages, so that the LLM, the GPU and the storage work at the same time:
+    the prompt generation, the audio (and loop) generation and the saving of the loops.
+    """
+    from .loopgen import LoopGenerator
+    from .util import AudioData
+
+    params_queue = asyncio.Queue(maxsize=PARAMS_QUEUE_SIZE)
+    store_queue = asyncio.Queue()
+    # taken from the queue, but not generated yet
+    in_progress = []
+
+    async def generate_prompts():
+        failures = 0
+        while True:
             try:
-                params_list = await prompt_provider.generate(max_count=10)
+                params_list = await prompt_provider.generate_many(PROMPTS_PER_FETCH, per_call=PROMPTS_PER_REQUEST)
             except Exception as ex:
                 logger.error("Error while generating prompts: %s", ex, exc_info=True)
-                await asyncio.sleep(0.1)
+                params_list = None
+            if not params_list:
+                # back off while the provider is failing, but stay responsive when it recovers
+                await asyncio.sleep(min(PROMPT_RETRY_MAX_DELAY, 0.1 * 2**failures))
+                # capped, past the max delay it only grows towards a float overflow
+                failures = min(failures + 1, 6)
                 continue
+            failures = 0
             for params in params_list:
-                while True: # retry the params until a loop is generated
-                    try:
-                        print(f"Generating music, be patient...")
-                        sr, audio_data = audiogen.generate(params)
-                        ad = AudioData(audio_data, sr)
-                        loopgen = LoopGenerator(ad, params)
-                        loop = loopgen.generate()
-                        if loop:
-                            audio_store.store(loop, params)
-                            print("\nSaved")
-                            break
-                        else:
-                            print("\nUnsuitable for looping, retrying...")
-                            continue
-                    except Exception as e:
-                        logger.error("Error while generating loop: %s", e, exc_info=True)
-                        break
-                await asyncio.sleep(0.1)
-        except KeyboardInterrupt:
-            break
+                # waits while the audio generation is behind
+                await params_queue.put(params)
+
+    # blocking, retries the params until a loop is generated
+    def generate_loop(params: "LoopGenParams", result) -> "AudioData":
+        while True:
+            if result is None:
+                print(f"Generating music, be patient...")
+                result = audiogen.generate(params)
+            sr, audio_data = result
+            result = None # any retry needs a new generation
+            loopgen = LoopGenerator(AudioData(audio_data, sr), params)
+            loop = loopgen.generate()
+            if loop:
+                return loop
+            print("\nUnsuitable for looping, retrying...")
+
+    async def generate_audio():
+        while True:
+            # batch whatever prompts are already waiting
+            params_list = [await params_queue.get()]
+            while len(params_list) < batch_size and not params_queue.empty():
+                params_list.append(params_queue.get_nowait())
+            in_progress.extend(params_list)
+            try:
+                print(f"Generating music, be patient...")
+                # prompts with the same generation settings share a single pass through the model
+                results = await asyncio.to_thread(audiogen.generate_batch, params_list, batch_size)
+            except Exception as e:
+                logger.error("Error while generating audio: %s", e, exc_info=True)
+                results = [None] * len(params_list)
+            for params, result in zip(params_list, results):
+                try:
+                    loop = await asyncio.to_thread(generate_loop, params, result)
+                    store_queue.put_nowait((loop, params))
+                except Exception as e:
+                    logger.error("Error while generating loop: %s", e, exc_info=True)
+                in_progress.remove(params)
+
+    store_task = asyncio.create_task(store_loops(audio_store, store_queue))
+    tasks = [asyncio.create_task(generate_prompts()), asyncio.create_task(generate_audio())]
+    try:
+        await asyncio.gather(*tasks)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        # the prompts which weren't used can be used next time
+        unused = list(in_progress)
+        while not params_queue.empty():
+            unused.append(params_queue.get_nowait())
+        try:
+            await prompt_provider.return_unused(unused)
+        except Exception as e:
+            logger.error("Error while returning the unused prompts: %s", e, exc_info=True)
+        # don't lose loops which are still being saved
+        await store_queue.join()
+        store_task.cancel()
+
+def run_event_loop(main):
+    """ Runs the coroutine like `asyncio.run`, on a (faster) uvloop event loop when available.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        logger.debug("Using the default asyncio event loop")
+        return asyncio.run(main)
+    logger.debug("Using the uvloop event loop")
+    if hasattr(asyncio, "Runner"): # Python 3.11+
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(main)
+    # no loop factories yet, but the event loop policies are not deprecated either
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(main)
 
 cli = typer.Typer()
 
+def version_callback(value: bool):
+    if value:
+        from . import __version__
+        print(__version__)
+        raise typer.Exit()
+
+@cli.callback()
+def main(
+    version:Annotated[bool, typer.Option("--version", help="Show the version and exit.", callback=version_callback, is_eager=True)] = False):
+    pass
+
 @cli.command(help="Generate a single audio loop reading all arguments from the command line. No LLM is used for the textual prompt generation.")
 def generate(
     # audio generation options
     prompt:Annotated[str, typer.Argument(help="The prompt to use for the audio generation model.")],
     audio_model:Annotated[str, typer.Option(help="The name of the MusicGen model to use.")] = None,
+    quantize:Annotated[bool, typer.Option(help="Quantize the MusicGen transformer weights to int8 to reduce the GPU memory use. Requires the bitsandbytes package.", is_flag=True)] = False,
+    cache:Annotated[bool, typer.Option(help="Cache the generated audio on disk, so repeating a generation with the same prompt, settings and (explicit) seed doesn't run the model again.", is_flag=True)] = False,
     bpm:Annotated[int, typer.Option(help="The beats per minute to target for the generated audio", min=24, max=240)] = 60,
     max_duration:Annotated[int, typer.Option(help="The maximum duration in seconds of the generated loop", min=8, max=128)] = 66,
     min_duration:Annotated[int, typer.Option(help="The minimum duration in seconds for the generated loop", min=8, max=128)] = 40,
     seed:Annotated[int, typer.Option(help="The seed to use for the varios random generators to allow reproducability. -1 for random.")] = -1,
+    socket_path:Annotated[str, typer.Option(help="The socket of a running 'serve' command to generate the audio with, instead of loading the model. Falls back to loading the model if the server isn't running or can't serve the request.")] = None,
     # storage options
     save_format:Annotated[SaveFormat, typer.Option(help="The format to use when exporting the generated audio file.")] = SaveFormat.mp3,
     dest_path:Annotated[str, typer.Option(help="Local path where to save the generated audio files.")] = None,
@@ -132,30 +290,45 @@ def generate(
     keep_metadata:Annotated[bool, typer.Option(help="Save a metadata json file with the audio file.", is_flag=True)]=False,
     # logging options
     log_level:Annotated[int, typer.Option(help="Log level as defined in the logging module (i.e. DEBUG=10, INFO=20 etc)")] = None):
+    from .loopgen import LoopGenerator
+    from .util import AudioData, LoopGenParams, setup_logging
     
     setup_logging(log_level=log_level)
     
     audio_store = create_store(save_format.value, dest_path, file_prefix, s3_bucket, s3_path, keep_metadata)
     
-    # generate an audio segment using the given parameters
-    audiogen = create_audio_generator(audio_model)
-    
     min_duration = min(max_duration, max(10, min_duration))
     params = LoopGenParams(prompt=prompt, bpm=bpm, max_duration=max_duration,
                             min_duration=min_duration, seed=seed)
-    sr, audio_data = audiogen.generate(params)
     
-    # trim it to form a loop
-    loopgen = LoopGenerator(AudioData(audio_data, sr), params)
-    loop = None
-    while not loop:
-        loop = loopgen.generate()
+    audiogen = None
+    for _ in range(1 + GENERATE_MAX_RETRIES):
+        # generate an audio segment using the given parameters, with the already loaded model of a running server if asked to
+        result = None
+        if audiogen is None and socket_path:
+            from .daemon import generate_remote
+            result = generate_remote(params, model_id=audio_model, quantize=quantize, cache=cache, socket_path=socket_path)
+        if result is None:
+            if audiogen is None:
+                audiogen = create_audio_generator(audio_model, quantize, cache=cache)
+            result = audiogen.generate(params)
+        sr, audio_data = result
+        
+        # trim it to form a loop
+        loop = LoopGenerator(AudioData(audio_data, sr), params).generate()
         if loop:
             # save it
             audio_store.store(loop, params)
             print("Saved")
-        else:
-            print("Unsuitable for looping, retrying...")
+            return
+        if seed > 0:
+            break # the same seed would only generate the same audio again
+        # the loop detection is deterministic, only new audio (with a new random seed) can give a different result
+        print("Unsuitable for looping, retrying...")
+    
+    logger.error("Couldn't generate a loop for prompt \"%s\"", prompt)
+    print("Unsuitable for looping, giving up!")
+    raise typer.Exit(code=2)
 
 @cli.command(help="Runs the loop generation in auto mode, using an LLM to generate the prompts and immediately pipe them to the audio generation module, eventually storing the results.")
 def auto(
@@ -165,8 +338,11 @@ def auto(
     use_case:Annotated[str, typer.Option(help="Extra use case details to send to the prompt generator to influence the type of melodies it would focus on.")] = None,
     # audio generation options
     audio_model:Annotated[str, typer.Option(help="The name of the MusicGen model to use.")] = None,
+    quantize:Annotated[bool, typer.Option(help="Quantize the MusicGen transformer weights to int8 to reduce the GPU memory use. Requires the bitsandbytes package.", is_flag=True)] = False,
+    cache:Annotated[bool, typer.Option(help="Cache the generated audio on disk, so repeating a generation with the same prompt, settings and (explicit) seed doesn't run the model again. Also keeps the LLM generated prompts which weren't used for the next run.", is_flag=True)] = False,
     max_duration:Annotated[int, typer.Option(help="The maximum duration in seconds of the generated loop", min=8, max=128)] = 66,
     min_duration:Annotated[int, typer.Option(help="The minimum duration in seconds for the generated loop", min=8, max=128)] = 40,
+    batch_size:Annotated[int, typer.Option(help="The maximum number of prompts to generate audio for at once. Higher values are faster, but need more GPU memory.", min=1, max=16)] = 1,
     # storage options
     save_format:Annotated[SaveFormat, typer.Option(help="The format to use when exporting the generated audio file.")] = SaveFormat.mp3,
     dest_path:Annotated[str, typer.Option(help="Local path where to save the generated audio files.")] = None,
@@ -176,15 +352,40 @@ def auto(
     keep_metadata:Annotated[bool, typer.Option(help="Save a metadata json file with the audio file.", is_flag=True)]=False,
     # logging options
     log_level:Annotated[int, typer.Option(help="Log level as defined in the logging module (i.e. DEBUG=10, INFO=20 etc)")] = None):
+    from .util import setup_logging
+
     setup_logging(log_level=log_level)
     
     audio_store = create_store(save_format.value, dest_path, file_prefix, s3_bucket, s3_path, keep_metadata)
     
-    prompt_provider = create_prompt_provider(prompt_provider, llm_model, use_case, max_duration, min_duration)
+    prompt_provider = create_prompt_provider(prompt_provider, llm_model, use_case, max_duration, min_duration, cache=cache)
     
-    audiogen = create_audio_generator(audio_model)
+    audiogen = create_audio_generator(audio_model, quantize, warmup=True, cache=cache)
     
     try:
-        asyncio.run(auto_loop(prompt_provider, audio_store, audiogen))
+        run_event_loop(auto_loop(prompt_provider, audio_store, audiogen, batch_size=batch_size))
     except asyncio.exceptions.CancelledError:
-        print("Exiting...")
\ No newline at end of file
+        print("Exiting...")
+
+@cli.command(help="Loads the audio model once and serves the audio generation for the 'generate' command on a local (unix) socket, so it doesn't need to load the model on every run.")
+def serve(
+    # audio generation options
+    audio_model:Annotated[str, typer.Option(help="The name of the MusicGen model to use.")] = None,
+    quantize:Annotated[bool, typer.Option(help="Quantize the MusicGen transformer weights to int8 to reduce the GPU memory use. Requires the bitsandbytes package.", is_flag=True)] = False,
+    cache:Annotated[bool, typer.Option(help="Cache the generated audio on disk, so repeating a generation with the same prompt, settings and (explicit) seed doesn't run the model again.", is_flag=True)] = False,
+    socket_path:Annotated[str, typer.Option(help="The socket to listen on. Defaults to audio_loop_gen.sock in the user's runtime folder ($XDG_RUNTIME_DIR), or the temp folder.")] = None,
+    # logging options
+    log_level:Annotated[int, typer.Option(help="Log level as defined in the logging module (i.e. DEBUG=10, INFO=20 etc)")] = None):
+    from .daemon import DEFAULT_SOCKET_PATH, serve as serve_forever
+    from .util import setup_logging
+
+    setup_logging(log_level=log_level)
+    
+    audiogen = create_audio_generator(audio_model, quantize, warmup=True, cache=cache)
+    
+    socket_path = socket_path or DEFAULT_SOCKET_PATH
+    print(f"Listening on {socket_path}, use 'generate --socket-path {socket_path}' to generate with this server...")
+    try:
+        serve_forever(audiogen, socket_path)
+    except KeyboardInterrupt:
+        print("Exiting...")
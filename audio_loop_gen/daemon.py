@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import tempfile
+from typing import Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from .util import LoopGenParams
+
+# The per-user runtime folder (only accessible by its owner) when there is one, otherwise the temp folder.
+# Either way the clients only talk to a socket owned by the same user and not accessible by anyone else.
+DEFAULT_SOCKET_PATH = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(), "audio_loop_gen.sock")
+
+# Protocol (one request per connection):
+#   request:  a JSON line {"model_id": str or null, "quantize": bool, "cache": bool, "params": LoopGenParams.to_dict()}
+#   response: a JSON line {"sample_rate": int, "shape": [int, ...]} followed by the float32 audio data,
+#             or a JSON line {"error": str} ({"unsupported": str} if the server can't serve the request at all)
+
+def serve(audiogen, socket_path: str = DEFAULT_SOCKET_PATH):
+    """ Serves audio generation requests with the given (loaded) AudioGenerator on a unix socket until interrupted.
+    The requests are handled one at a time, as they'd compete for the GPU anyway.
+
+    Args:
+        audiogen (AudioGenerator): The generator to use.
+        socket_path (str, optional): The socket to listen on. Defaults to DEFAULT_SOCKET_PATH.
+
+    Raises:
+        ValueError: If unix sockets are not supported or another server already listens on the socket.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError("Unix sockets are not supported on this platform")
+    if os.path.exists(socket_path):
+        if _is_listening(socket_path):
+            raise ValueError(f"A server is already listening on {socket_path}")
+        os.remove(socket_path) # left over from a server which didn't shut down cleanly
+    # no one else may connect (and send prompts or receive the audio), the socket is created with owner-only access
+    old_umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, _RequestHandler)
+    finally:
+        os.umask(old_umask)
+    with server:
+        server.audiogen = audiogen
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+def generate_remote(params: LoopGenParams, model_id: str = None, quantize: bool = False, cache: bool = False,
+                    socket_path: str = DEFAULT_SOCKET_PATH) -> Tuple[int, ndarray]:
+    """ Generates the audio using a server started with `serve`.
+
+    Args:
+        params (LoopGenParams): The parameters to use for generation.
+        model_id (str, optional): The MusicGen model the audio must be generated with. Defaults to whatever model the server uses.
+        quantize (bool, optional): Whether the server's model must be quantized. Defaults to False.
+        cache (bool, optional): Whether the server must cache the generated audio. Defaults to False.
+        socket_path (str, optional): The socket the server listens on. Defaults to DEFAULT_SOCKET_PATH.
+
+    Returns:
+        Tuple[int, ndarray]: The sample rate and audio data, or None if no (suitable, working) server is running,
+            so the caller should generate the audio itself.
+    """
+    logger = logging.getLogger("global")
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    if not _is_trusted(socket_path):
+        logger.warning("Not using the server at %s: the socket doesn't exist, isn't owned by the current user or is accessible by others", socket_path)
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            with sock.makefile("rb") as rfile:
+                request = {"model_id": model_id, "quantize": quantize, "cache": cache, "params": params.to_dict()}
+                sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+                header = json.loads(rfile.readline())
+                if "unsupported" in header:
+                    logger.info("Not using the server at %s: %s", socket_path, header["unsupported"])
+                    return None
+                if "error" in header:
+                    raise ValueError(header["error"])
+                shape = tuple(header["shape"])
+                # read straight into a writable buffer, no copy needed
+                data = bytearray(int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+                if rfile.readinto(data) != len(data):
+                    raise ValueError("Incomplete response from the server")
+                return header["sample_rate"], np.frombuffer(data, dtype=np.float32).reshape(shape)
+    except (OSError, ValueError, KeyError) as e: # json.JSONDecodeError is a ValueError
+        logger.warning("Not using the server at %s: %s", socket_path, e)
+        return None
+
+def _is_trusted(socket_path: str) -> bool:
+    """ Whether the socket belongs to the current user and no one else can access it (i.e. it wasn't created by someone
+    else to receive the prompts and return arbitrary audio).
+    """
+    try:
+        st = os.stat(socket_path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & (stat.S_IRWXG | stat.S_IRWXO)
+
+def _is_listening(socket_path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+            return True
+        except OSError:
+            return False
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        logger = logging.getLogger("global")
+        audiogen = self.server.audiogen
+        try:
+            request = json.loads(self.rfile.readline())
+            model_id = request.get("model_id")
+            if model_id and model_id != audiogen.model_id:
+                self.__write_header({"unsupported": f"the server uses {audiogen.model_id}, not {model_id}"})
+                return
+            if bool(request.get("quantize")) != audiogen.quantize:
+                self.__write_header({"unsupported": f"the server's model is{'' if audiogen.quantize else ' not'} quantized"})
+                return
+            if request.get("cache") and not audiogen.cache_dir:
+                self.__write_header({"unsupported": "the server doesn't cache the generated audio"})
+                return
+            params = LoopGenParams(**request["params"])
+            sample_rate, audio = audiogen.generate(params)
+        except Exception as e:
+            logger.error("Error while serving a request: %s", e, exc_info=True)
+            self.__write_header({"error": str(e)})
+            return
+        audio = np.ascontiguousarray(audio, dtype=np.float32)
+        self.__write_header({"sample_rate": sample_rate, "shape": list(audio.shape)})
+        self.wfile.write(audio.tobytes())
+
+    def __write_header(self, header: dict):
+        self.wfile.write(json.dumps(header).encode("utf-8") + b"\n")
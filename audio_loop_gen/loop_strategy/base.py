@@ -1,5 +1,8 @@
+import functools
 import logging
+from typing import Tuple
 import numpy as np
+from numpy import ndarray
 
 from ..util import AudioData, fade_in, fade_out, align_phase
 
@@ -11,6 +14,17 @@ FADE_OUT_DURATION_MS = 800
 FADE_OUT_MIN_LEVEL = 0.5
 FADE_OUT_MAX_LEVEL = 1.0
 
+@functools.lru_cache(maxsize=8)
+def _blend_ramps(samples: int) -> Tuple[ndarray, ndarray]:
+    """ Returns the (fade_in, fade_out) linear ramps for a blend of the given length.
+    The length only depends on the sample rate, so the same ramps are reused for every loop. They are read-only as they're shared.
+    """
+    c_in = np.linspace(0, 1, samples, dtype=np.float32)
+    c_out = np.linspace(1, 0, samples, dtype=np.float32)
+    c_in.flags.writeable = False
+    c_out.flags.writeable = False
+    return c_in, c_out
+
 class LoopStrategy(object):
     strategy_id: str = None
     
@@ -76,13 +90,16 @@ class LoopStrategy(object):
         lead_start = max(loop_start - blend_samples // 2, 0)
         blend_end = min(loop_end + blend_samples // 2, audio_data.shape[1])
         lead = audio_data[:, lead_start:lead_start + blend_samples]
-        audio_data = audio_data.copy()
-        c_in = np.linspace(0, 1, blend_samples)
-        c_out = np.linspace(1, 0, blend_samples)
-        audio_data[:, blend_end - blend_samples: blend_end] *= c_out
-        audio_data[:, blend_end - blend_samples: blend_end] += c_in * lead[:, :]
+        c_in, c_out = _blend_ramps(blend_samples)
+        # copy only the loop window, the lead is read from the untouched source
+        blend_start = blend_end - blend_samples
+        audio_data = audio_data[:, loop_start:loop_end].copy()
+        # the part of the blend window after loop_end would be cut anyway
+        kept = loop_end - blend_start
+        tail = audio_data[:, blend_start - loop_start:]
+        tail *= c_out[:kept]
+        tail += c_in[:kept] * lead[:, :kept]
         
-        audio_data = audio_data[:, loop_start:loop_end]
         audio_data = fade_in(audio_data, loop.sample_rate, fade_duration_ms=FADE_IN_DURATION_MS, min_level=FADE_IN_MIN_LEVEL, max_level=FADE_IN_MAX_LEVEL, in_place=True)
         audio_data = fade_out(audio_data, loop.sample_rate, fade_duration_ms=FADE_OUT_DURATION_MS, min_level=FADE_OUT_MIN_LEVEL, max_level=FADE_OUT_MAX_LEVEL, in_place=True)
         
@@ -1,6 +1,8 @@
+from typing import Dict, Tuple
 import numpy as np
 import librosa
 import warnings
+import torch
 from BeatNet.BeatNet import BeatNet
 
 from .base import LoopStrategy
@@ -8,6 +10,16 @@ from ..util import AudioData
 
 warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning) # numpy deprecation warnings from BeatNet
 
+BEATNET_MODE = "offline"
+BEATNET_INFERENCE_MODEL = "DBN"
+BEATNET_DEVICE = "cuda"
+# Run BeatNet's activation network in float16 on CUDA. The DBN decoder only sees the (float32) softmax posteriors,
+# which the lower precision doesn't visibly change. Set to False for GPUs without fast float16.
+BEATNET_HALF_PRECISION = True
+
+# Loaded BeatNet models shared by all BeatDetect instances in the process, keyed by (mode, inference_model, device)
+_BEATNET_CACHE: Dict[Tuple[str, str, str], BeatNet] = {}
+
 class BeatDetect(LoopStrategy):
     strategy_id: str = "BeatDetect"
     def __init__(self, audio: AudioData, min_loop_duration:int = 20000):
@@ -15,14 +27,24 @@ class BeatDetect(LoopStrategy):
         self.__loop_start: int = -1
         self.__loop_end: int = -1
         self.__evaluated = False
-        self.beatnet = BeatNet(
-            1,
-            mode="offline",
-            inference_model="DBN",
-            plot=[],
-            thread=False,
-            device="cuda",
-        )
+
+    @property
+    def beatnet(self) -> BeatNet:
+        """ The BeatNet model, loaded once per process (on first use) and reused.
+        """
+        key = (BEATNET_MODE, BEATNET_INFERENCE_MODEL, BEATNET_DEVICE)
+        beatnet = _BEATNET_CACHE.get(key)
+        if beatnet is None:
+            beatnet = BeatNet(
+                1,
+                mode=BEATNET_MODE,
+                inference_model=BEATNET_INFERENCE_MODEL,
+                plot=[],
+                thread=False,
+                device=BEATNET_DEVICE,
+            )
+            _BEATNET_CACHE[key] = beatnet
+        return beatnet
 
     def evaluate(self) -> bool:
         """Evaluates if the audio is suitable for this loop strategy.
@@ -33,12 +55,20 @@ class BeatDetect(LoopStrategy):
         if self.__evaluated:
             return self.__loop_start >= 0 and self.__loop_end >= 0
         
+        if self.audio.duration < self.min_loop_duration: # no loop can be long enough, don't bother running BeatNet
+            self.__evaluated = True
+            return False
+        
         sample_rate = self.audio.sample_rate
         start_time, end_time = -1, -1
         
-        # Normalize
+        # Normalize, the peak from max/min doesn't allocate an abs() copy of the whole signal
         mono_samples = self.audio.mono_audio_data[0]
-        normalized_audio = mono_samples / np.abs(mono_samples).max()
+        peak = max(mono_samples.max(), -mono_samples.min())
+        if peak <= 0: # silence
+            self.__evaluated = True
+            return False
+        normalized_audio = mono_samples / peak
         
         try:
             # Estimate beats
@@ -91,8 +121,12 @@ class BeatDetect(LoopStrategy):
             audio_data,
             orig_sr=sample_rate,
             target_sr=self.beatnet.sample_rate,
+            res_type="soxr_hq", # much faster than the resampy filters, and plenty for beat detection
         )
-        return self.beatnet.process(input)
+        # autocast keeps the softmax (and so the posteriors handed to the DBN) in float32
+        with torch.autocast(device_type="cuda", dtype=torch.float16,
+                            enabled=BEATNET_HALF_PRECISION and BEATNET_DEVICE == "cuda"):
+            return self.beatnet.process(input)
     
     def __get_loop_points(self, beats):
         """
@@ -114,7 +148,8 @@ class BeatDetect(LoopStrategy):
             raise ValueError("Not enough bars")
 
         # extract an even number of bars
-        even_num_bars = int(2 ** np.floor(np.log2(num_bars)))
+        # i.e. the largest power of 2 <= num_bars
+        even_num_bars = 1 << (num_bars.bit_length() - 1)
         start_time = downbeat_times[0]
         end_time = downbeat_times[even_num_bars]
         
@@ -1,5 +1,4 @@
 import numpy as np
-import librosa
 
 from .base import LoopStrategy
 from ..util import AudioData, equal_power_crossfade, fade_out
@@ -40,10 +39,7 @@ class CrossFade(LoopStrategy):
         if self.__is_suitable is not None:
             return self.__is_suitable
 
-        mono_samples = self.audio.mono_audio_data[0]
-
-        spectral_centroids = librosa.feature.spectral_centroid(
-            y=mono_samples, sr=self.audio.sample_rate)
+        spectral_centroids = self.audio.features.spectral_centroid
         self.__is_suitable = np.var(spectral_centroids) < type(
             self).SPECTRAL_CENTROIDS_THRESHOLD
 
@@ -62,6 +58,6 @@ class CrossFade(LoopStrategy):
         if not self.evaluate():
             raise ValueError("Audio is not suitable for crossfade looping")
         self.logger.debug("Using %s strategy for loop", type(self).strategy_id)
-        loop = equal_power_crossfade(self.audio.audio_data, self.audio.sample_rate, crossfade_duration_ms=self(type).CROSSFADE_DURATION_MS)
+        loop = equal_power_crossfade(self.audio.audio_data, self.audio.sample_rate, crossfade_duration_ms=type(self).CROSSFADE_DURATION_MS)
         loop = fade_out(loop, self.audio.sample_rate, fade_duration_ms=600, in_place=True)
         return AudioData(loop, self.audio.sample_rate)
\ No newline at end of file
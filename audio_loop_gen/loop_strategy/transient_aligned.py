@@ -40,6 +40,10 @@ class TransientAligned(LoopStrategy):
         if self.__evaluated:
             return self.__loop_start >= 0
 
+        if self.audio.duration < self.min_loop_duration:  # no loop can be long enough
+            self.__evaluated = True
+            return False
+
         mono_samples = self.audio.mono_audio_data[0]
 
         transients = self.__transient_detection(
@@ -93,19 +97,20 @@ class TransientAligned(LoopStrategy):
             int: The threshold for the number of transients required for the audio data's suitability.
         """
         # Feature extraction
-        rms_energy = np.sqrt(np.mean(np.square(audio_data)))  # 0.0 - 1.0
-        spectral_flatness = librosa.feature.spectral_flatness(y=audio_data)[
-            0].mean()  # 0.0 - 1.0
+        # the dot product sums the squares without allocating a squared copy of the signal
+        rms_energy = np.sqrt(np.dot(audio_data, audio_data) / audio_data.size)  # 0.0 - 1.0
+        spectral_flatness = self.audio.features.spectral_flatness[0].mean()  # 0.0 - 1.0
         # originally it's between 0.0 - 2.0
         dynamic_range_norm = (np.max(audio_data) - np.min(audio_data)) / 2
 
+        cls = type(self)
         # Weighted combination
-        combined_metric = rms_energy * type(self).WEIGHT_RMS_ENERGY + spectral_flatness * type(
-            self).WEIGHT_SPECTRAL_FLATNESS + dynamic_range_norm * type(self).WEIGHT_DYNAMIC_RANGE
+        combined_metric = rms_energy * cls.WEIGHT_RMS_ENERGY + spectral_flatness * \
+            cls.WEIGHT_SPECTRAL_FLATNESS + dynamic_range_norm * cls.WEIGHT_DYNAMIC_RANGE
 
         # Map to threshold range (example, adjust based on testing)
-        min_threshold = type(self).MIN_TRANSIENTS_THRESHOLD
-        max_threshold = type(self).MAX_TRANSIENTS_THRESHOLD
+        min_threshold = cls.MIN_TRANSIENTS_THRESHOLD
+        max_threshold = cls.MAX_TRANSIENTS_THRESHOLD
         threshold = int(min_threshold + (max_threshold -
                         min_threshold) * combined_metric)
 
@@ -113,12 +118,15 @@ class TransientAligned(LoopStrategy):
 
     def __transient_detection(self, audio_data, sample_rate):
         """Combine onset strength and spectral flux for improved transient detection."""
-        # Onset strength
+        # Both metrics are computed from the same STFT (with onset_strength's default n_fft and hop_length), shared with the other strategies
+        S = self.audio.features.stft_magnitude
+
+        # Onset strength, from the log-power mel spectrogram like onset_strength(y=...) would compute
+        mel = librosa.feature.melspectrogram(S=S**2, sr=sample_rate)
         onset_env = librosa.onset.onset_strength(
-            y=audio_data, sr=sample_rate)
+            S=librosa.power_to_db(mel), sr=sample_rate)
 
         # Spectral flux
-        S = np.abs(librosa.stft(audio_data))
         spectral_flux = librosa.onset.onset_strength(
             S=librosa.amplitude_to_db(S, ref=np.max))
 
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from .util import AudioData, LoopGenParams, prune_silence
 from .loop_strategy import LoopStrategy, TransientAligned, CrossFade, BeatDetect
 
@@ -14,10 +16,21 @@ class LoopGenerator(object):
 
     def generate(self) -> AudioData:
         loop = None
-        for strategy in self.__strategies:
+        if not self.__strategies:
+            return loop
+        if len(self.__strategies) == 1:
+            # a fixed strategy_id, nothing to evaluate in parallel
+            strategy = self.__strategies[0]
             if strategy.evaluate():
                 loop = strategy.create_loop()
-                loop = loop
+            return loop
+        # The strategies are independent (BeatNet mostly on the GPU, the others on the CPU), so evaluate them all at once.
+        # The first suitable one in the order of preference is used.
+        with ThreadPoolExecutor(max_workers=len(self.__strategies), thread_name_prefix="loop_strategy") as executor:
+            suitable = list(executor.map(lambda strategy: strategy.evaluate(), self.__strategies))
+        for strategy, is_suitable in zip(self.__strategies, suitable):
+            if is_suitable:
+                loop = strategy.create_loop()
                 self.__params.strategy_id = strategy.strategy_id
                 break
         return loop
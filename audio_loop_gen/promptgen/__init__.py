@@ -1,4 +1,13 @@
 from .base import PromptGenerator
-from .ollama import Ollama
-from .openai import OpenAI
-from .manual import Manual
\ No newline at end of file
+from .manual import Manual
+from .cache import CachedPromptGenerator
+
+def __getattr__(name: str):
+    # the LLM client packages are slow to import, so only the provider which is actually used gets loaded
+    if name == "Ollama":
+        from .ollama import Ollama
+        return Ollama
+    if name == "OpenAI":
+        from .openai import OpenAI
+        return OpenAI
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,12 +1,24 @@
+import asyncio
+import functools
 import random
 import re
 import logging
+from typing import Iterator, Tuple
 from typing_extensions import Callable, Concatenate, ParamSpec
 from ..util import LoopGenParams
 
 PS = ParamSpec("PS")
-NUMBERED_LINE_REGEX = re.compile(r"^\d+[\.]?\s+(.*)")
+# The number of loops to ask an LLM for in a single request by `generate_many`
+DEFAULT_PER_CALL = 16
+# ... and the maximum number of those requests in flight at once, enough for the server to batch them without queueing up a backlog
+DEFAULT_MAX_INFLIGHT = 4
+# The characters to strip around the parts of an LLM response line
+_STRIP_CHARS = " '`\"\t"
+# A "<prompt>|<bpm>" line of an LLM response, optionally numbered and wrapped in spaces/quotes (which are not part of the prompt)
+PARAMS_LINE_REGEX = re.compile(r"^[ '`\"\t]*(?:\d+\.?[ \t]+)?(?P<prompt>[^|\r\n]+)\|[ '`\"\t]*(?P<bpm>\d+)[ '`\"\t]*\r?$", re.MULTILINE)
 
+# The system message is sent in 2 parts: the static instructions first, identical in every request, so that the LLM
+# providers' prompt (prefix) caching can reuse them, followed by the randomized optional parts and examples.
 LLM_CHAT_SYSTEM_MESSAGE = \
 """Act as a music expert who can come up with a wide variety of prompts for music generation using an AI model.
 
@@ -15,19 +27,24 @@ For each music piece you shoult answer with a single line of 2 parts separated b
 These are the main parts of a prompt:
 - melody: A mandatory part that describes the melody in 3-6 words. Mandatory! This can be a simple melody or a more complex one. It should reflect the mood and vary significantly from prompt to prompt.
 - instrumentation: A mandatory part listing the 2-3 main instruments playing the music. For example, "guitar and drums" or "piano, strings, and sax".
-{parts}
+- optional parts: The optional parts of a prompt are listed after these instructions.
 
 2. "bpm" is the beats per minute as an integer between 30 and 150.
 
 DO always include the `melody` and `instrumentation` parts!
 DO always include the prompt and the bpm value on the same line and separated with the pipe symbol "|"!
-DO pick 1-2 random optional parts from the list above to create a unique prompt!
+DO pick 1-2 random optional parts from the list of optional parts to create a unique prompt!
 DO select the bpm values to match the melody description!
 DO prefer bpm values between 50 and 120, 80 percent of bpm values should be in this range!
 DO NOT generate prompts longer than 160 characters!
 DO NOT include any other information in your answer!
 DO NOT use any quotes or backticks in your answer!
 DO NOT number the lines in your answer!
+"""
+
+LLM_CHAT_VARIETY_MESSAGE = \
+"""The optional parts of a prompt:
+{parts}
 
 Some examples of correct responses:
 {examples}
@@ -53,31 +70,65 @@ MUSIC_PROMPT_EXAMPLES = [
     "A dynamic blend of hip-hop and orchestral elements, with sweeping strings and brass, evoking the vibrant energy of the city|100",
 ]
 
-def trim_line(text:str) -> str:
-    # Replace the entire text with the first captured group
-    text = strip_space_and_quotes(text)
-    text = NUMBERED_LINE_REGEX.sub(r"\1", text)
-    return strip_space_and_quotes(text)
+# The variety message split around its placeholders once, so building it is a plain join instead of a str.format() parse
+_VARIETY_MESSAGE_HEAD, _, _VARIETY_MESSAGE_REST = LLM_CHAT_VARIETY_MESSAGE.partition("{parts}")
+_VARIETY_MESSAGE_MIDDLE, _, _VARIETY_MESSAGE_TAIL = _VARIETY_MESSAGE_REST.partition("{examples}")
 
-def strip_space_and_quotes(text:str) -> str:
-    return text.strip(" '`\"")
+def parse_params_lines(content: str) -> Iterator[Tuple[str, int]]:
+    """ Extracts the (prompt, bpm) pairs from an LLM response with one "<prompt>|<bpm>" line per set of parameters.
+    The whole response is scanned in one pass, any lines not in that format (the LLM can generate garbage) are skipped.
+
+    Args:
+        content (str): The response content.
+
+    Returns:
+        Iterator[Tuple[str, int]]: The prompt and bpm of each valid line, in order.
+    """
+    for match in PARAMS_LINE_REGEX.finditer(content):
+        prompt = match.group("prompt").strip(_STRIP_CHARS)
+        if prompt:
+            yield prompt, int(match.group("bpm"))
+
+def llm_chat_system_messages(seed: int = -1) -> list[dict]:
+    """ The system messages to start an LLM chat with: the static instructions, then the randomized variety message.
+
+    Args:
+        seed (int, optional): The seed for the randomization, -1 for random. Defaults to -1.
+
+    Returns:
+        list[dict]: The chat messages.
+    """
+    return [{"role": "system", "content": LLM_CHAT_SYSTEM_MESSAGE},
+            {"role": "system", "content": randomized_llm_chat_system_message(seed)}]
 
 def randomized_llm_chat_system_message(seed = -1):
     if seed >= 0:
-        random.seed(seed)
+        return _seeded_llm_chat_system_message(seed)
+    return _build_llm_chat_system_message(random)
+
+@functools.lru_cache(maxsize=128)
+def _seeded_llm_chat_system_message(seed: int) -> str:
+    # the same seed always produces the same message, so it's built once. Using its own generator also leaves
+    # the global random state alone, which seeding it used to reset for everyone else
+    return _build_llm_chat_system_message(random.Random(seed))
+
+def _build_llm_chat_system_message(rng: random.Random) -> str:
     # randomize the instructions slightly to avoid getting too similar prompts
     parts = MUSIC_PROMPT_PARTS[:]
-    random.shuffle(parts)
-    examples = random.sample(MUSIC_PROMPT_EXAMPLES, 3)
-    return LLM_CHAT_SYSTEM_MESSAGE.format(parts="\n".join(parts), examples="\n".join(examples))
+    rng.shuffle(parts)
+    examples = rng.sample(MUSIC_PROMPT_EXAMPLES, 3)
+    return "".join((_VARIETY_MESSAGE_HEAD, "\n".join(parts), _VARIETY_MESSAGE_MIDDLE, "\n".join(examples), _VARIETY_MESSAGE_TAIL))
+
+def default_params_callback(prompt: str, bpm: int, **kwargs) -> LoopGenParams:
+    # LoopGenParams itself can't be the callback, its second positional parameter is `min_duration`, not `bpm`
+    return LoopGenParams(prompt=prompt, bpm=bpm, **kwargs)
 
 class PromptGenerator(object):
     """ Base class for prompt generators.
     """
     def __init__(self, use_case:str = None, params_callback: Callable[Concatenate[str, int, PS], LoopGenParams] = None):
         self.use_case = use_case
-        self.params_callback = params_callback if params_callback else lambda prompt, bpm, **kwargs: LoopGenParams(
-            prompt=prompt, bpm=bpm, **kwargs)
+        self.params_callback = params_callback or default_params_callback
         self.logger = logging.getLogger("global")
         
     async def generate(self, max_count: int = 1, seed:int = -1) -> list[LoopGenParams]:
@@ -90,4 +141,38 @@ class PromptGenerator(object):
         Returns:
             list[LoopGenParams]: List of LoopGenParams with size less than or equal to `max_count`.
         """
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+    async def return_unused(self, params_list: list[LoopGenParams]):
+        """ Hands back generated params which weren't used after all (e.g. when the generation was interrupted).
+        Generators which keep their prompts for later runs should hand them out again, the others can ignore them.
+
+        Args:
+            params_list (list[LoopGenParams]): The unused params, in the order they were generated.
+        """
+        pass
+
+    async def generate_many(self, total: int, per_call: int = DEFAULT_PER_CALL, max_inflight: int = DEFAULT_MAX_INFLIGHT) -> list[LoopGenParams]:
+        """ Generate generation params for a larger number of loops, split into concurrent `generate` calls of up to `per_call` loops each.
+        An LLM server which batches the requests it has in flight (like Ollama) works on them at once, instead of one
+        long request generating everything sequentially.
+
+        Args:
+            total (int): The number of loops we want to generate.
+            per_call (int, optional): The maximum number of loops to generate in a single call. Defaults to DEFAULT_PER_CALL.
+            max_inflight (int, optional): The maximum number of calls running at once. Defaults to DEFAULT_MAX_INFLIGHT.
+
+        Returns:
+            list[LoopGenParams]: List of LoopGenParams with size less than or equal to `total`.
+        """
+        if total < 1 or per_call < 1 or max_inflight < 1:
+            raise ValueError(f"Invalid total {total}, per call {per_call} or in flight {max_inflight} count")
+        semaphore = asyncio.Semaphore(max_inflight)
+
+        async def generate_bounded(count: int) -> list[LoopGenParams]:
+            async with semaphore:
+                return await self.generate(max_count=count)
+
+        counts = [min(per_call, total - start) for start in range(0, total, per_call)]
+        results = await asyncio.gather(*(generate_bounded(count) for count in counts))
+        return [params for params_list in results for params in params_list]
\ No newline at end of file
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import sqlite3
+import threading
+
+from .base import PromptGenerator, DEFAULT_PER_CALL, DEFAULT_MAX_INFLIGHT
+from ..util import LoopGenParams
+
+class CachedPromptGenerator(PromptGenerator):
+    """ Keeps the prompts generated by another (LLM based) generator in a SQLite database and hands them out in the order
+    they were generated. The prompts which weren't used survive restarts, so they don't need to be generated (and paid for) again.
+    """
+    def __init__(self, generator: PromptGenerator, db_path: str):
+        """ Creates a new CachedPromptGenerator.
+
+        Args:
+            generator (PromptGenerator): The generator to cache the prompts of.
+            db_path (str): The SQLite database file to keep the prompts in. Created if it doesn't exist.
+        """
+        super().__init__(use_case=generator.use_case, params_callback=generator.params_callback)
+        self.__generator = generator
+        # prompts generated for one use case don't fit the others
+        self.__use_case_key = generator.use_case or ""
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # the database is accessed from worker threads (one at a time), so the event loop doesn't wait for the disk
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(db_path, check_same_thread=False)
+        # The prompts are cheap to lose compared to a stalled pipeline: with WAL and synchronous=NORMAL the commits don't wait
+        # for an fsync, at the cost of (at most) the last batch of prompts on a power loss.
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute("PRAGMA busy_timeout=5000")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS prompts (id INTEGER PRIMARY KEY, use_case TEXT NOT NULL, prompt TEXT NOT NULL, bpm INTEGER NOT NULL)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS prompts_use_case ON prompts (use_case, id)")
+        self.__db.commit()
+
+    async def generate(self, max_count: int = 1, seed: int = -1) -> list[LoopGenParams]:
+        """ Returns the oldest cached prompts, generating (and caching) a new batch first if there are not enough of them.
+        A seeded request is passed on to the wrapped generator, as it expects a reproducible result.
+        """
+        if seed is not None and seed >= 0:
+            return await self.__generator.generate(max_count=max_count, seed=seed)
+        if await asyncio.to_thread(self.__count) < max_count:
+            params_list = await self.__generator.generate(max_count=max_count)
+            await asyncio.to_thread(self.__insert, params_list)
+        rows = await asyncio.to_thread(self.__pop, max_count)
+        return [self.params_callback(prompt, bpm) for prompt, bpm in rows]
+
+    async def generate_many(self, total: int, per_call: int = DEFAULT_PER_CALL, max_inflight: int = DEFAULT_MAX_INFLIGHT) -> list[LoopGenParams]:
+        """ Like `generate` for a larger number of prompts, with any missing ones generated by the wrapped generator's `generate_many`.
+        """
+        if total < 1 or per_call < 1 or max_inflight < 1:
+            raise ValueError(f"Invalid total {total}, per call {per_call} or in flight {max_inflight} count")
+        if await asyncio.to_thread(self.__count) < total:
+            params_list = await self.__generator.generate_many(total, per_call=per_call, max_inflight=max_inflight)
+            await asyncio.to_thread(self.__insert, params_list)
+        rows = await asyncio.to_thread(self.__pop, total)
+        return [self.params_callback(prompt, bpm) for prompt, bpm in rows]
+
+    async def return_unused(self, params_list: list[LoopGenParams]):
+        """ Puts the unused prompts back to the front of the cache, so they are the first ones handed out (in the same order) next time.
+        """
+        if params_list:
+            await asyncio.to_thread(self.__put_back, params_list)
+
+    def __count(self) -> int:
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(*) FROM prompts WHERE use_case = ?", (self.__use_case_key,)).fetchone()[0]
+
+    def __insert(self, params_list: list[LoopGenParams]):
+        with self.__lock:
+            self.__db.executemany("INSERT INTO prompts (use_case, prompt, bpm) VALUES (?, ?, ?)",
+                                  [(self.__use_case_key, params.prompt, params.bpm) for params in params_list])
+            self.__db.commit()
+
+    def __put_back(self, params_list: list[LoopGenParams]):
+        with self.__lock:
+            # ids below the current smallest one (they may go negative), the prompts are handed out by id
+            min_id = self.__db.execute("SELECT MIN(id) FROM prompts").fetchone()[0]
+            first_id = (1 if min_id is None else min_id) - len(params_list)
+            self.__db.executemany("INSERT INTO prompts (id, use_case, prompt, bpm) VALUES (?, ?, ?, ?)",
+                                  [(first_id + i, self.__use_case_key, params.prompt, params.bpm) for i, params in enumerate(params_list)])
+            self.__db.commit()
+
+    def __pop(self, max_count: int) -> list[tuple[str, int]]:
+        """ Removes and returns the (prompt, bpm) of the oldest max_count cached prompts.
+        """
+        with self.__lock:
+            rows = self.__db.execute("SELECT id, prompt, bpm FROM prompts WHERE use_case = ? ORDER BY id LIMIT ?",
+                                     (self.__use_case_key, max_count)).fetchall()
+            if rows:
+                self.__db.execute("DELETE FROM prompts WHERE use_case = ? AND id <= ?", (self.__use_case_key, rows[-1][0]))
+                self.__db.commit()
+        return [(prompt, bpm) for _, prompt, bpm in rows]
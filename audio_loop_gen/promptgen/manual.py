@@ -1,7 +1,7 @@
 import asyncio
 from typing_extensions import Callable, Concatenate
 
-from .base import PromptGenerator, PS
+from .base import PromptGenerator, PS, DEFAULT_PER_CALL, DEFAULT_MAX_INFLIGHT
 from ..util import LoopGenParams
 
 class Manual(PromptGenerator):
@@ -10,13 +10,21 @@ class Manual(PromptGenerator):
         super().__init__(use_case=use_case, params_callback = params_callback)
 
     async def generate(self, max_count: int = 1, seed: int = -1) -> list[LoopGenParams]:
+        # the whole dialog runs in one worker thread, instead of a round trip to the thread pool for every input()
+        return await asyncio.to_thread(self.__read_params, max_count)
+
+    async def generate_many(self, total: int, per_call: int = DEFAULT_PER_CALL, max_inflight: int = DEFAULT_MAX_INFLIGHT) -> list[LoopGenParams]:
+        # there's only one console to read from, so the params are entered one after the other anyway
+        return await self.generate(max_count=total)
+
+    def __read_params(self, max_count: int) -> list[LoopGenParams]:
         loop_gen_params = []
 
-        print(f"Enter parameters for up to {max_count} loops" + " for the use case: \"{self.use_case}\"..." if self.use_case else "...")
+        print(f"Enter parameters for up to {max_count} loops" + (f" for the use case: \"{self.use_case}\"..." if self.use_case else "..."))
         for i in range(max_count):
             print(f"Parameters for loop {i + 1}:")
-            prompt = await asyncio.to_thread(input, "Enter prompt: ")
-            bpm_input = await asyncio.to_thread(input, "Enter bpm: ")
+            prompt = input("Enter prompt: ")
+            bpm_input = input("Enter bpm: ")
             try:
                 bpm = int(bpm_input)
             except ValueError:
@@ -24,7 +32,7 @@ class Manual(PromptGenerator):
                 bpm = 60
             loop_gen_params.append(self.params_callback(prompt, bpm))
             if i < max_count - 1:
-                go_on = await asyncio.to_thread(input, "Continue? (y/n): ")
+                go_on = input("Continue? (y/n): ")
                 if go_on.lower() != "y":
                     break
 
@@ -1,7 +1,9 @@
 import ollama
 from typing_extensions import Callable, Concatenate
 
-from .base import PromptGenerator, trim_line, randomized_llm_chat_system_message, PS
+from typing import Dict, List, Tuple
+
+from .base import PromptGenerator, parse_params_lines, llm_chat_system_messages, PS
 from ..util import LoopGenParams
 
 LLAMA_CHAT_USER_MESSAGE_TEMPLATE = "Generate {count} sets of parameters for generating a melody."
@@ -14,6 +16,9 @@ class Ollama(PromptGenerator):
             model_id = "mistral"
         self.__model_id = model_id
         self.__ollama_client = ollama.AsyncClient()
+        # The (prompt, bpm) pairs parsed from the responses to seeded requests, keyed by (use_case, seed, max_count).
+        # The same seeded request always gets the same response, so the LLM isn't asked again.
+        self.__seeded_responses: Dict[Tuple[str, int, int], List[Tuple[str, int]]] = {}
 
     async def generate(self, max_count=1, seed: int = -1) -> list[LoopGenParams]:
         """
@@ -33,15 +38,17 @@ class Ollama(PromptGenerator):
         if seed is None or seed < -1:
             seed = -1
 
-        sys_message = randomized_llm_chat_system_message(seed)
+        cache_key = (self.use_case, seed, max_count)
+        if seed >= 0 and cache_key in self.__seeded_responses:
+            # new params every time, the callers may modify them
+            return [self.params_callback(prompt, bpm) for prompt, bpm in self.__seeded_responses[cache_key]]
 
         message = LLAMA_CHAT_USER_MESSAGE_TEMPLATE.format(count=max_count)
         if self.use_case:
             message += " " + \
                 LLAMA_CHAT_USER_MESSAGE_TEMPLATE_USE_CASE_EXTRA.format(
                     use_case=self.use_case)
-        messages = [{"role": "system", "content": sys_message},
-                    {"role": "user", "content": message}]
+        messages = llm_chat_system_messages(seed) + [{"role": "user", "content": message}]
 
         response = await self.__ollama_client.chat(
             model=self.__model_id,
@@ -49,26 +56,13 @@ class Ollama(PromptGenerator):
             options=ollama.Options(seed = seed)
         )
 
-        params_list = []
+        pairs: List[Tuple[str, int]] = []
         message: dict = response.get("message")
         if message:
             content: str = message.get("content")
             if content:
                 # We asked the LLM for 1 line per params set
-                lines = content.splitlines()
-                for line in lines:
-                    line = trim_line(line)
-                    # each line should have the format: "<prompt>|bpm"
-                    try:
-                        parts = line.split("|", maxsplit=1)
-                        if len(parts) < 2:
-                            self.logger.debug(
-                                "Invalid llama response line: %s", line)
-                            continue
-                        params = self.params_callback(parts[0], int(parts[1].strip()))
-                        params_list.append(params)
-                    except Exception as e:
-                        # The LLM can generate garbage, which we'll just ignore
-                        self.logger.debug("Error parsing llama response line %s", line, exc_info=e)
-                        continue
-        return params_list
+                pairs = list(parse_params_lines(content))
+        if seed >= 0:
+            self.__seeded_responses[cache_key] = pairs
+        return [self.params_callback(prompt, bpm) for prompt, bpm in pairs]
@@ -1,7 +1,7 @@
 from typing_extensions import Callable, Concatenate
 import openai
 
-from .base import PromptGenerator, trim_line, randomized_llm_chat_system_message, PS
+from .base import PromptGenerator, parse_params_lines, llm_chat_system_messages, PS
 from ..util import LoopGenParams
 
 OPENAI_CHAT_COMPLETION_USER_MESSAGE_TEMPLATE = "Generate {count} sets of parameters for generating a melody."
@@ -37,12 +37,10 @@ class OpenAI(PromptGenerator):
         if seed is None or seed < -1:
             seed = -1
 
-        sys_message = randomized_llm_chat_system_message(seed)
-        
         message = OPENAI_CHAT_COMPLETION_USER_MESSAGE_TEMPLATE.format(count=max_count)
         if self.use_case:
             message += " " + OPENAI_CHAT_COMPLETION_USER_MESSAGE_TEMPLATE_USE_CASE_EXTRA.format(use_case=self.use_case)
-        messages = [{"role": "system", "content": sys_message}, {"role": "user", "content": message}]
+        messages = llm_chat_system_messages(seed) + [{"role": "user", "content": message}]
 
         response = await self.__openai_client.chat.completions.create(
             model=self.__model_id,
@@ -60,20 +58,5 @@ class OpenAI(PromptGenerator):
                 if not response_message:
                     continue
                 # We asked the LLM for 1 line per params set
-                lines = response_message.splitlines()
-                for line in lines:
-                    line = trim_line(line)
-                    # each line should have the format: "<prompt>|bpm"
-                    try:
-                        parts = line.split("|", maxsplit=1)
-                        if len(parts) < 2:
-                            self.logger.debug(
-                                "Invalid OpenAI response line: %s", line)
-                            continue
-                        params = self.params_callback(parts[0], int(parts[1].strip()))
-                        params_list.append(params)
-                    except Exception as e:
-                        # The LLM can generate garbage, which we'll just ignore
-                        self.logger.debug("Error parsing OpenAI response line %s", line, exc_info=e)
-                        continue
+                params_list.extend(self.params_callback(prompt, bpm) for prompt, bpm in parse_params_lines(response_message))
         return params_list
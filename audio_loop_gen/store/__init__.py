@@ -1,3 +1,9 @@
 from .base import AudioStore, AudioHandler
 from .file import FileDataHandler
-from .s3 import S3DataHandler
\ No newline at end of file
+
+def __getattr__(name: str):
+    # boto3 is slow to import and only needed when storing to S3
+    if name == "S3DataHandler":
+        from .s3 import S3DataHandler
+        return S3DataHandler
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,15 +1,20 @@
 import uuid6
 import logging
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 
 from ..util import AudioData, LoopGenParams
 
+DEFAULT_MAX_WORKERS = 8
+
 class AudioStore(object):
     """ Stores audio using a list of handlers.
     """
-    def __init__(self, handlers: list['AudioHandler']):
+    def __init__(self, handlers: list['AudioHandler'], max_workers: int = DEFAULT_MAX_WORKERS):
         self.__handlers = handlers
+        self.__max_workers = max_workers
+        self.__executor = None
         self.__logger = logging.getLogger("global")
         
     def store(self, audio: AudioData, params:LoopGenParams):
@@ -22,6 +27,19 @@ class AudioStore(object):
                 handler.handle(audio, params)
             except Exception as e:
                 self.__logger.error("Error storing audio with handler %s: %s", handler, e)
+
+    def store_many(self, items: list[tuple[AudioData, LoopGenParams]]):
+        """ Saves all the given audio using all configured handlers and waits until they're saved.
+        
+        The items are saved in parallel, as most of the time is spent encoding (ffmpeg) and uploading the files,
+        outside of the GIL.
+        """
+        if len(items) == 1:
+            self.store(*items[0])
+            return
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix="store")
+        list(self.__executor.map(lambda item: self.store(*item), items))
  
 class AudioHandler(object):      
     """ Base class for audio handlers.
@@ -1,7 +1,7 @@
 import os
 import tempfile
 import logging
-import boto3
+import threading
 
 from .base import AudioHandler
 from ..util import AudioData, LoopGenParams, export_audio
@@ -14,7 +14,8 @@ class S3DataHandler(AudioHandler):
         self.__bucket = bucket
         self.__prefix = prefix if prefix else ""
         self.__format = format if format and format != "" else "wav"
-        self.__s3_client = boto3.client('s3')
+        self.__s3_client = None
+        self.__client_lock = threading.Lock()
         self.__logger = logging.getLogger("general")
         
     def base_name(self, audio: AudioData):
@@ -22,6 +23,15 @@ class S3DataHandler(AudioHandler):
         """
         return f"{self.__prefix}{super().base_name(audio)}"
     
+    def __client(self):
+        """ Creates the S3 client on first use, so that creating the handler doesn't pay for importing boto3 and resolving the credentials.
+        """
+        with self.__client_lock: # the handler may be used from multiple threads
+            if self.__s3_client is None:
+                import boto3
+                self.__s3_client = boto3.client('s3')
+        return self.__s3_client
+
     def handle(self, audio: AudioData, params:LoopGenParams):
         """ Saves the given audio to a file in the S3 bucket encoded in the correct format and under the configured path (prefix).
 
@@ -36,15 +46,14 @@ class S3DataHandler(AudioHandler):
             # export to the temp file
             noext, _ = os.path.splitext(temp_file.name)
             export_audio(audio, noext, self.__format)
-            with open(temp_file.name, "rb") as f:
-                data = f.read()
             base_name = self.base_name(audio)
             key = f"{base_name}.{self.__format}"
-            self.__s3_client.put_object(Bucket=self.__bucket, Key=key, Body=data)
+            # streams the file in chunks (multipart for large files) instead of reading it all in memory first
+            self.__client().upload_file(temp_file.name, self.__bucket, key)
             if self.keep_metadata:
                 metadata = self.metadata(params, audio)
                 key = f"{base_name}.json"
-                self.__s3_client.put_object(Bucket=self.__bucket, Key=key, Body=metadata)
+                self.__client().put_object(Bucket=self.__bucket, Key=key, Body=metadata)
         finally:
             if temp_file:
                 try:
@@ -1,12 +1,16 @@
 """ Utility and helper functions for audio processing and loop generation.
 """
+import atexit
+import functools
 import hashlib
 import os
 import random
 from typing import Tuple
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
 import struct
+import threading
 
 import numpy as np
 from numpy import ndarray
@@ -21,14 +25,18 @@ class AudioData:
     """
 
     def __init__(self, audio_data: ndarray, sample_rate: int):
-        self.__audio_data = audio_data
+        # channel-major (channels, samples) float32, as MusicGen produces it. A no-op for such arrays, while anything else
+        # (e.g. a strided slice or float64 data) is converted once, not by every analysis that reads it
+        self.__audio_data = np.ascontiguousarray(audio_data, dtype=np.float32)
+        audio_data = self.__audio_data
         self.__sample_rate = sample_rate
         self.__mono_audio_data: ndarray = None
+        self.__features: AudioFeatures = None
+        # the strategies analyze the audio in parallel, the lazily computed mono mix and features must still be created only once
+        self.__lock = threading.Lock()
         self.__is_stereo = audio_data.ndim == 2 and audio_data.shape[0] == 2
-        if self.__is_stereo:
-            self.__length: int = audio_data.shape[1]
-        else:
-            self.__length: int = len(audio_data)
+        # the samples are the last axis for (samples), (1, samples) and (2, samples) alike
+        self.__length: int = audio_data.shape[-1]
         self.__duration: int = (
             self.__length * 1000) // sample_rate  # in milliseconds
 
@@ -42,13 +50,31 @@ class AudioData:
 
     @property
     def mono_audio_data(self) -> ndarray:
+        """ The (1, samples) mono mix of the audio, computed once. It's shared by every analysis of the audio (and for mono audio
+        it's a view of the audio data itself), so it's read-only.
+        """
         if self.__mono_audio_data is None:
-            if self.is_stereo:
-                self.__mono_audio_data = np.atleast_2d(self.audio_data.mean(axis=0))
-            else:
-                self.__mono_audio_data = self.audio_data
+            with self.__lock:
+                if self.__mono_audio_data is None:
+                    if self.is_stereo:
+                        mono = np.atleast_2d(self.audio_data.mean(axis=0))
+                    else:
+                        # a view, shaped like the stereo mix, so mono_audio_data[0] is the samples in both cases
+                        mono = np.atleast_2d(self.audio_data).view()
+                    mono.setflags(write=False)
+                    self.__mono_audio_data = mono
         return self.__mono_audio_data
 
+    @property
+    def features(self) -> 'AudioFeatures':
+        """ The spectral features of the (mono) audio, computed on first use and shared by everyone analyzing this audio.
+        """
+        if self.__features is None:
+            with self.__lock:
+                if self.__features is None:
+                    self.__features = AudioFeatures(self)
+        return self.__features
+
     @property
     def duration(self):
         return self.__duration
@@ -77,21 +103,51 @@ class AudioData:
     @staticmethod
     def deserialize(data:bytes) -> 'AudioData':
         # Unpack sample_rate and num_channels (first 8 bytes, 4 bytes each for int32)
-        sample_rate, num_channels = struct.unpack('ii', data[:8])
-        # Extract the audio_data bytes
-        audio_data_bytes = data[8:]
+        sample_rate, num_channels = struct.unpack_from('ii', data)
 
-        # Reconstruct the audio_data ndarray
+        # Reconstruct the audio_data ndarray straight from the buffer (slicing bytes would copy it)
         # The dtype is assumed to be float32, and shape depends on num_channels
-        if num_channels == 1:
-            audio_data = np.frombuffer(audio_data_bytes, dtype=np.float32)
-        elif num_channels == 2:
-            num_samples_per_channel = len(audio_data_bytes) // (num_channels * np.dtype(np.float32).itemsize)
-            audio_data = np.frombuffer(audio_data_bytes, dtype=np.float32).reshape((2, num_samples_per_channel))
+        audio_data = np.frombuffer(data, dtype=np.float32, offset=8)
+        if num_channels == 2:
+            audio_data = audio_data.reshape((2, -1))
             
-        audio_data = audio_data.copy() # writable copy
+        audio_data = audio_data.copy() # writable copy, the only one
         return AudioData(audio_data, sample_rate)
 
+class AudioFeatures:
+    """ Lazily computed spectral features of the mono audio data, so the loop strategies evaluating the same audio share
+    a single STFT instead of each computing its own. Uses librosa's default STFT parameters (n_fft=2048, hop_length=512).
+    """
+
+    def __init__(self, audio: AudioData):
+        self.__audio = audio
+        # the strategies are evaluated in parallel, the features should still be computed only once
+        self.__lock = threading.RLock()
+        self.__stft_magnitude: ndarray = None
+        self.__spectral_centroid: ndarray = None
+        self.__spectral_flatness: ndarray = None
+
+    @property
+    def stft_magnitude(self) -> ndarray:
+        with self.__lock:
+            if self.__stft_magnitude is None:
+                self.__stft_magnitude = np.abs(librosa.stft(self.__audio.mono_audio_data[0]))
+        return self.__stft_magnitude
+
+    @property
+    def spectral_centroid(self) -> ndarray:
+        with self.__lock:
+            if self.__spectral_centroid is None:
+                self.__spectral_centroid = librosa.feature.spectral_centroid(S=self.stft_magnitude, sr=self.__audio.sample_rate)
+        return self.__spectral_centroid
+
+    @property
+    def spectral_flatness(self) -> ndarray:
+        with self.__lock:
+            if self.__spectral_flatness is None:
+                self.__spectral_flatness = librosa.feature.spectral_flatness(S=self.stft_magnitude)
+        return self.__spectral_flatness
+
 class LazyLoggable(object):
     def __init__(self, callable, *args, **kwargs):
         self.__callable = callable
@@ -193,6 +249,22 @@ class LoopGenParams(AudioGenParams):
         data["strategy_id"] = self.strategy_id
         return data
 
+@functools.lru_cache(maxsize=8)
+def _equal_power_ramps(samples: int, min_level: float, max_level: float) -> Tuple[ndarray, ndarray]:
+    """ Returns the (fade_out, fade_in) equal power curves for a crossfade of the given length.
+
+    The crossfade durations used throughout the library are constants, so the curves are computed once and shared.
+    They are contiguous float32 and read-only, so a caller can't modify the shared copy by accident.
+    """
+    # Create equal power crossfade curves using sine and cosine
+    half_pi = np.pi / 2
+    t = np.linspace(min_level*half_pi, max_level*half_pi, samples, dtype=np.float32)
+    fade_out = np.cos(t)  # Decreases in volume
+    fade_in = np.sin(t)   # Increases in volume
+    fade_out.setflags(write=False)
+    fade_in.setflags(write=False)
+    return fade_out, fade_in
+
 def crossfade(audio_data: np.ndarray, sample_rate: int, crossfade_duration_ms: int, min_level: float = 0.0, max_level = 1.0) -> np.ndarray:
     """ Applies a crossfade effect to the end of an audio segment.
 
@@ -260,10 +332,7 @@ def equal_power_crossfade(audio_data: np.ndarray, sample_rate: int, crossfade_du
         raise ValueError(
             "Crossfade duration is too long for the length of the audio.")
 
-    # Create equal power crossfade curves using sine and cosine
-    t = np.linspace(min_level*np.pi / 2, max_level*np.pi / 2, crossfade_samples, dtype=np.float32)
-    fade_out = np.cos(t)  # Decreases in volume
-    fade_in = np.sin(t)   # Increases in volume
+    fade_out, fade_in = _equal_power_ramps(crossfade_samples, min_level, max_level)
 
     # Apply fade-out to the end segment
     end_faded = audio_data[:, -crossfade_samples:] * fade_out
@@ -357,11 +426,7 @@ def equal_power_crossfade_arrays(audio_a: np.ndarray, audio_b: np.ndarray, sampl
     if crossfade_samples > min(audio_a.shape[1], audio_b.shape[1]):
         raise ValueError("Crossfade duration is too long for the length of one or both audio segments.")
 
-    # Create equal power crossfade curves using sine and cosine
-    half_pi = np.pi / 2
-    t = np.linspace(min_level*half_pi, max_level*half_pi, crossfade_samples, dtype=np.float32)
-    fade_out = np.cos(t)  # Decreases in volume
-    fade_in = np.sin(t)   # Increases in volume
+    fade_out, fade_in = _equal_power_ramps(crossfade_samples, min_level, max_level)
 
     # Apply fade-out to the end of the first audio segment
     end_faded = audio_a[:, -crossfade_samples:] * fade_out
@@ -377,6 +442,14 @@ def equal_power_crossfade_arrays(audio_a: np.ndarray, audio_b: np.ndarray, sampl
 
     return final_audio
 
+@functools.lru_cache(maxsize=8)
+def _linear_ramp(samples: int, start_level: float, end_level: float) -> ndarray:
+    """ Returns a linear fade curve of the given length, shared like the curves of `_equal_power_ramps`.
+    """
+    ramp = np.linspace(start_level, end_level, samples, dtype=np.float32)
+    ramp.setflags(write=False)
+    return ramp
+
 def fade_in(audio_data: np.ndarray, sample_rate: int, fade_duration_ms: int, min_level: float = 0.0, max_level: float = 1.0, in_place: bool = False) -> np.ndarray:
     """ Applies a fade-in effect to the start of an audio segment.
 
@@ -389,7 +462,7 @@ def fade_in(audio_data: np.ndarray, sample_rate: int, fade_duration_ms: int, min
         np.ndarray: The audio data with the fade-in effect applied. It's a copy of the original audio data, which is not modified.
     """
     fade_samples = int(sample_rate * fade_duration_ms / 1000)
-    fade = np.linspace(min_level, max_level, fade_samples, dtype=np.float32)
+    fade = _linear_ramp(fade_samples, min_level, max_level)
     # Create a copy of the audio data
 
     if not in_place:
@@ -412,7 +485,7 @@ def fade_out(audio_data: np.ndarray, sample_rate: int, fade_duration_ms: int, mi
         np.ndarray: The audio data with the fade-out effect applied. It's a copy of the original audio data, which is not modified.
     """
     fade_samples = int(sample_rate * fade_duration_ms / 1000)
-    fade = np.linspace(max_level, min_level, fade_samples, dtype=np.float32)
+    fade = _linear_ramp(fade_samples, max_level, min_level)
 
     if not in_place:
         audio_data = audio_data.copy()
@@ -532,7 +605,7 @@ def prune_silence(audio: AudioData, min_silence_ms: int = 1000, keep_silence_ms:
     """ Cleans up the silent parts of an audio segment.
 
         The logic is like this:
-        1. Trims all the silence from the start and end of the audio 
+        1. Trims all the silence from the start and end of the audio (i.e. everything before the first and after the last non-silent interval)
         2. Replace any internal silence intervals longer than `min_silence_ms` with silence of `keep_silence_ms` milliseconds.
 
         The threshold for silence is determined by `top_db` which is the threshold (in decibels) below reference to consider as silence 
@@ -554,9 +627,7 @@ def prune_silence(audio: AudioData, min_silence_ms: int = 1000, keep_silence_ms:
     logger = logging.getLogger("global")
     logger.debug("Pruning silence from audio. Initial duration: %dms", audio.duration)
     
-    # Trim silence from the start and end of the audio
-    audio_data, _ = librosa.effects.trim(audio.audio_data, top_db=top_db)
-    logger.debug("Trimmed silence from the ends. New duration: %dms", (len(audio_data) if audio_data.ndim == 1 else audio_data.shape[1]) * 1000 // audio.sample_rate)
+    audio_data = audio.audio_data
     
     # Convert silence duration from milliseconds to number of samples
     min_silence = int(audio.sample_rate * min_silence_ms / 1000)
@@ -571,7 +642,8 @@ def prune_silence(audio: AudioData, min_silence_ms: int = 1000, keep_silence_ms:
     else:
         audio_data_mono = audio_data
 
-    # Detect non-silent intervals
+    # Detect non-silent intervals. The silence at the ends is trimmed by only keeping what's between the first and the last of them,
+    # no need for a separate (librosa.effects.trim) pass over the audio
     non_silent_intervals = librosa.effects.split(
         audio_data_mono, top_db=top_db)
     
@@ -580,8 +652,8 @@ def prune_silence(audio: AudioData, min_silence_ms: int = 1000, keep_silence_ms:
     for start, end in non_silent_intervals:
         logger.debug("Non-silent interval: %ds - %ds", start/audio.sample_rate, end/audio.sample_rate)
         # Update prev_end to the end of the last interval in filtered_intervals
-        prev_end = filtered_intervals[-1][1] if filtered_intervals else 0
-        if start > 0:
+        if filtered_intervals:
+            prev_end = filtered_intervals[-1][1]
             if start - prev_end > min_silence:
                 logger.debug("Keeping interval: %ds - %ds", (start - keep_silence) / audio.sample_rate, end / audio.sample_rate)
                 # Add interval with silence wrapped around
@@ -591,28 +663,20 @@ def prune_silence(audio: AudioData, min_silence_ms: int = 1000, keep_silence_ms:
                 logger.debug("Expanding previous non-silent interval end from %ds to %ds", filtered_intervals[-1][1] / audio.sample_rate, end / audio.sample_rate)
                 filtered_intervals[-1] = (filtered_intervals[-1][0], end)
         else:
-            filtered_intervals.append((0, end))
-
-    # Initialize a list to hold processed audio for each channel
-    processed_audio_channels = []
-
-    # Process each channel based on the filtered intervals
-    processed_audio_1 = []
-    processed_audio_2 = []
+            # the first non-silent interval, the leading silence is dropped
+            filtered_intervals.append((start, end))
+
+    # Allocate the output once and copy each kept interval (all channels at once) straight into its place
+    total_length = sum(end - start for start, end in filtered_intervals)
+    logger.debug("Pruned silence. New duration: %dms", total_length * 1000 // audio.sample_rate)
+    processed_audio = np.empty((channels, total_length), dtype=audio_data.dtype)
+    write_pos = 0
     for start, end in filtered_intervals:
         logger.debug("Keeping interval %ds - %ds", start / audio.sample_rate, end / audio.sample_rate)
-        # Append the non-silent audio chunk for this channel
-        processed_audio_1.append(audio_data[0, start:end])
-        if channels > 1:
-            processed_audio_2.append(audio_data[1, start:end])
-    # Concatenate processed chunks and add to the channel list
-    processed_audio_channels.append(np.concatenate(processed_audio_1, axis=0))
-    if channels > 1:
-        processed_audio_channels.append(
-            np.concatenate(processed_audio_2, axis=0))
-
-    # Stack processed channels back into multi-channel format
-    return AudioData(np.stack(processed_audio_channels, axis=0), audio.sample_rate)
+        processed_audio[:, write_pos:write_pos + end - start] = audio_data[:channels, start:end]
+        write_pos += end - start
+
+    return AudioData(processed_audio, audio.sample_rate)
 
 def adjust_loop_ends(loop: AudioData, loop_start: int, loop_end: int) -> tuple[int, int]:
     """Adjust the loop using the proximity of onsets to the loop ends
@@ -712,14 +776,14 @@ def export_audio(audio: AudioData, filename_base: str, format="wav"):
     audio_write(filename_base, wav, audio.sample_rate,
                 strategy="loudness", loudness_compressor=True, format=format, make_parent_dir=True)
 
-def set_all_seeds(seed):
+def set_all_seeds(seed, deterministic: bool = False):
     # From https://gist.github.com/gatheluck/c57e2a40e3122028ceaecc3cb0d152ac
     random.seed(seed)
     os.environ["PYTHONHASHSEED"] = str(seed)
     np.random.seed(seed)
-    torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
+    torch.manual_seed(seed) # seeds all the CUDA devices too
+    # deterministic cuDNN kernels are slower, only worth it when the result must be reproducible
+    torch.backends.cudnn.deterministic = deterministic
     
 def calculate_checksum(data: bytes):
     return hashlib.md5(data).hexdigest()
@@ -741,7 +805,14 @@ def setup_logging(logs_file:str = "global.log", logs_path: str = os.path.join(".
     handler.setFormatter(logging.Formatter(
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 
+    # Write to the file from a background thread, so logging doesn't block the callers (i.e. the event loop) on disk I/O
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop) # flushes the queued records on exit
+
     # Add the handler to the logger
-    logger.addHandler(handler)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.propagate = False
 
     return logger
\ No newline at end of file
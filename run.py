@@ -1,4 +1,10 @@
-from audio_loop_gen import cli
+import sys
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["--version"]:
+        # answer without importing typer and the cli
+        from audio_loop_gen import __version__
+        print(__version__)
+        sys.exit(0)
+    from audio_loop_gen import cli
     cli.cli()
\ No newline at end of file